@@ -4,102 +4,437 @@
 
 import os  # For filesystem operations
 import flask  # Flask web framework
+import flask_caching  # For caching rendered pages
+import werkzeug.routing  # For the camera name URL converter
 import datetime  # For date and time handling
+import functools  # For memoizing timestamp formatting
+import itertools  # For grouping files by day
 import sys  # For sys.argv (ensure this is only imported once)
 import pytz  # For timezone handling
-import argparse  # For command-line argument parsing
+import numpy as np  # For vectorized date bucketing
+import bisect  # For nearest-timestamp lookups
+import concurrent.futures  # For scanning cameras in parallel
+import threading  # For the background cache refresher
+import time  # For the refresher's sleep interval
+import mimetypes  # For Content-Type of offloaded media
+import urllib.parse  # For quoting X-Accel-Redirect paths
+import waitress  # Multi-threaded production WSGI server
+import watchdog.events  # For filesystem change notifications
+import watchdog.observers  # For watching the camera directories
+import diskcache  # For persisting camera data across restarts
 
 # Path to the directory containing all camera subdirectories
 cams_directory: str               = ""
 cams_prefix: str                  = ""
 cams_images_extentions: list[str] = []
 cams_videos_extentions: list[str] = []
+_IMG_EXTS: frozenset[str]         = frozenset()
+_VID_EXTS: frozenset[str]         = frozenset()
 debug: bool                       = False
 port: int                         = 5000
+threads: int                      = 8
+watch: bool                       = True
+accel_redirect: str               = ""
+state_dir: str                    = ""
 
 app = flask.Flask(__name__)
 
-# Simple cache for camera data to avoid frequent disk reads
-camera_data_cache: dict[str, dict] = None
-camera_data_cache_time: float = 0
+
+class CamConverter(werkzeug.routing.BaseConverter):
+    """URL converter that only matches camera names, so other names 404 in routing."""
+    regex = r'cam[^/]*'
+
+
+app.url_map.converters['cam'] = CamConverter
+
+# Per-camera cache for camera data to avoid frequent disk reads.
+# A background thread rescans cameras, so requests normally never pay for a scan.
+# While the filesystem watcher runs, cameras are rescanned after their files changed,
+# plus an hourly full rescan in case events were lost, and entries never expire;
+# otherwise they are rescanned periodically.
+camera_data_cache: dict[str, tuple[float, dict]] = {}  # cam -> (scan time, data)
+camera_list_cache: list[str] = None
+camera_list_cache_time: float = 0
+camera_list_html: str = "<ul></ul>"  # Rendered camera list of the index page, rebuilt with the list
+camera_data_lock = threading.Lock()
 CACHE_TTL: int = 300  # Cache time-to-live in seconds
+CAMERA_LIST_TTL: int = 60  # Time-to-live of the list of camera directories
+CACHE_REFRESH_INTERVAL: int = 150  # Seconds between background rescans
+SCAN_WORKERS: int = 32  # Max cameras scanned in parallel
+WATCH_DEBOUNCE: float = 2  # Seconds to let a burst of file events settle before rescanning
+WATCH_FULL_RESCAN_INTERVAL: int = 3600  # Full rescan while watching, in case events were lost
+# Cameras with file changes that are not rescanned yet; the event wakes the refresher
+camera_dirty: set[str] = set()
+camera_dirty_lock = threading.Lock()
+camera_dirty_event = threading.Event()
+watching: bool = False  # True while the filesystem watcher is running
+# On-disk copy of camera_data_cache so a restarted process starts warm; None when disabled
+persistent_cache: diskcache.Cache = None
+background_workers_started: bool = False
+background_workers_lock = threading.Lock()
+PERSIST_TTL: int = 86400  # Seconds a persisted camera entry is kept after its last scan
+persisted_mtimes: dict[str, float] = {}  # cam -> directory mtime stored with its persisted entry
+CAMERA_DATA_FORMAT: int = 3  # Bump when get_camera_data's result changes shape; older persisted entries are ignored
+# Incremented whenever cached camera data changes; part of every page cache key
+data_version: int = 0
+
+# Cache for rendered HTML pages
+cache = flask_caching.Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': CACHE_TTL})
 
 # Define CET timezone
 CET = pytz.timezone('CET')
+EPOCH_DATE = datetime.date(1970, 1, 1)  # Day 0 of cet_day_numbers
+
+MKV_STREAM_CHUNK_SIZE: int = 64 * 1024  # Max bytes per read from the ffmpeg pipe
+
+
+def _env_settings():
+    """Returns the configuration given by environment variables, with defaults for unset ones."""
+    return {
+        'dir':               os.environ.get("SECURECAM_DIR", "/cameras/"),
+        'prefix':            os.environ.get("SECURECAM_PREFIX", "cam"),
+        'images_extensions': os.environ.get("SECURECAM_IMAGES_EXTENSIONS", ".jpg .jpeg .png").split(),
+        'videos_extensions': os.environ.get("SECURECAM_VIDEOS_EXTENSIONS", ".mp4 .mkv").split(),
+        'debug':             os.environ.get("SECURECAM_DEBUG", "0") != "0",
+        'port':              int(os.environ.get("SECURECAM_PORT", "5000")),
+        'threads':           int(os.environ.get("SECURECAM_THREADS", "8")),
+        'watch':             os.environ.get("SECURECAM_WATCH", "1") != "0",
+        'accel_redirect':    os.environ.get("SECURECAM_ACCEL_REDIRECT", ""),
+        'state_dir':         os.environ.get("SECURECAM_STATE_DIR", "/var/lib/securecam"),
+    }
+
+
+def _apply_settings(settings):
+    """Sets the configuration globals and the values derived from them."""
+    global cams_directory, cams_prefix, cams_images_extentions, cams_videos_extentions, debug, port, threads, watch
+    global accel_redirect, state_dir, _IMG_EXTS, _VID_EXTS
+    cams_directory         = settings['dir']
+    cams_prefix            = settings['prefix']
+    cams_images_extentions = settings['images_extensions']
+    cams_videos_extentions = settings['videos_extensions']
+    debug                  = settings['debug']
+    port                   = settings['port']
+    threads                = settings['threads']
+    watch                  = settings['watch']
+    accel_redirect         = settings['accel_redirect']
+    state_dir              = settings['state_dir']
+
+    # Lowercase extension sets for constant-time classification while scanning
+    _IMG_EXTS = normalize_extensions(cams_images_extentions)
+    _VID_EXTS = normalize_extensions(cams_videos_extentions)
 
 
-def init():
-    """Initialize configuration from command-line arguments or environment variables."""
-    global cams_directory, cams_prefix, cams_images_extentions, cams_videos_extentions, debug, port
+def _configure_from_env():
+    """Initialize configuration from environment variables; used when imported by a WSGI server."""
+    _apply_settings(_env_settings())
+
+
+def _configure_from_argv():
+    """Initialize configuration from command-line arguments, defaulting to environment variables."""
+    import argparse  # Only needed when run as a script
+    defaults = _env_settings()
     parser = argparse.ArgumentParser(description="SecureCam Web Interface")
     parser.add_argument(
-        '-d', '--dir', 
-        type=str, 
-        default=os.environ.get("SECURECAM_DIR", "/cameras/"), 
+        '-d', '--dir',
+        type=str,
+        default=defaults['dir'],
         help='Directory containing camera subdirectories')
     parser.add_argument(
         '-p','--prefix',
         type=str,
-        default=os.environ.get("SECURECAM_PREFIX", "cam"),
+        default=defaults['prefix'],
         help='Prefix for camera directories')
     parser.add_argument(
         '-i', '--images-extensions',
         type=str,
         nargs='+',
-        default=['.jpg', '.jpeg', '.png'],
+        default=defaults['images_extensions'],
         help='List of image file extensions')
     parser.add_argument(
         '-v', '--videos-extensions',
         type=str,
         nargs='+',
-        default=['.mp4', '.mkv'],
+        default=defaults['videos_extensions'],
         help='List of video file extensions')
     parser.add_argument(
         '-D', '--debug',
         action='store_true',
-        default=False,
+        default=defaults['debug'],
         help='Enable debug mode')
     parser.add_argument(
         '-P', '--port',
         type=int,
-        default=5000,
+        default=defaults['port'],
         help='Port to run the web server on')
-    args = parser.parse_args()
+    parser.add_argument(
+        '-t', '--threads',
+        type=int,
+        default=defaults['threads'],
+        help='Number of threads serving requests (ignored in debug mode)')
+    parser.add_argument(
+        '--no-watch',
+        dest='watch',
+        action='store_false',
+        default=defaults['watch'],
+        help='Rescan periodically instead of watching for file changes '
+             '(for network mounts written by other hosts, where inotify sees no events)')
+    parser.add_argument(
+        '-X', '--accel-redirect',
+        type=str,
+        default=defaults['accel_redirect'],
+        help='Internal nginx location mapped to the cameras directory (e.g. /internal_media/); '
+             'when set, .jpg and .mp4 files are sent by nginx via X-Accel-Redirect')
+    parser.add_argument(
+        '-s', '--state-dir',
+        type=str,
+        default=defaults['state_dir'],
+        help='Directory where scanned camera data is persisted across restarts (empty to disable)')
+    _apply_settings(vars(parser.parse_args()))
 
-    cams_directory         = args.dir
-    cams_prefix            = args.prefix
-    cams_images_extentions = args.images_extensions
-    cams_videos_extentions = args.videos_extensions
-    debug                  = args.debug
-    port                   = args.port
 
+def start_background_workers():
+    """
+    Opens the persistent cache, seeds the camera cache from it and starts the file watcher
+    and cache refresher. Runs once; later calls do nothing. A persistent cache or watcher
+    that cannot be used is logged and skipped, so the refresher always starts.
+    """
+    global background_workers_started, persistent_cache
+    with background_workers_lock:
+        if background_workers_started:
+            return
+        if state_dir and persistent_cache is None:
+            try:
+                persistent_cache = diskcache.Cache(state_dir)
+            except Exception as e:
+                # OSError for the directory itself, sqlite3.Error for an unusable cache.db
+                persistent_cache = None
+                print(f"[CACHE] Not persisting camera data, cannot use {state_dir}: {e}")
+        try:
+            load_persisted_camera_data()
+        except Exception as e:
+            print(f"[CACHE] Could not load persisted camera data: {e}")
+        if watch and not watching:
+            start_file_watcher()
+        start_cache_refresher()
+        # Only set once everything is running, so a failure above is retried on the next request
+        background_workers_started = True
 
-def get_all_camera_data():
+
+@app.before_request
+def ensure_background_workers():
+    # Under a WSGI server nothing calls start_background_workers() before the first request
+    if not background_workers_started:
+        try:
+            start_background_workers()
+        except Exception as e:
+            # Requests are still served, scanning on demand, without the background workers
+            print(f"[CACHE] Could not start background workers: {e}")
+
+
+def get_camera_list():
+    """Returns the sorted list of camera directory names, cached for CAMERA_LIST_TTL seconds."""
+    global camera_list_cache, camera_list_cache_time, camera_list_html, data_version
+    now = datetime.datetime.now().timestamp()
+    if camera_list_cache is not None and now - camera_list_cache_time < CAMERA_LIST_TTL:
+        return camera_list_cache
+    cameras = sorted(cam for cam in os.listdir(cams_directory) if cam.startswith(cams_prefix))
+    if cameras != camera_list_cache:
+        camera_list_html = "<ul>" + "".join(['<li><a href="/camera/%s">%s</a></li>' % (cam, cam) for cam in cameras]) + "</ul>"
+        data_version += 1
+    camera_list_cache = cameras
+    camera_list_cache_time = now
+    return camera_list_cache
+
+
+def get_cached_camera_data(cam):
     """
-    Collects and caches data for all cameras.
-    Returns a dictionary mapping camera names to their data.
+    Returns the cached data for a camera, scanning it only when no valid entry exists.
+    The lock makes sure concurrent requests do not scan the same camera twice.
+    Raises KeyError for names that are not camera directories.
     """
-    global cams_directory, cams_prefix, camera_data_cache, camera_data_cache_time
+    global data_version
+    if cam not in get_camera_list():
+        raise KeyError(cam)
     now = datetime.datetime.now().timestamp()
-    # Use cached data if still valid
-    if camera_data_cache is not None and now - camera_data_cache_time < CACHE_TTL:
-        return camera_data_cache
-    camera_data = {}
-    # Scan all camera directories
-    for cam in os.listdir(cams_directory):
-        if not cam.startswith(cams_prefix):
+    entry = camera_data_cache.get(cam)
+    if entry is not None and (watching or now - entry[0] < CACHE_TTL):
+        return entry[1]
+    with camera_data_lock:
+        entry = camera_data_cache.get(cam)
+        if entry is not None and (watching or now - entry[0] < CACHE_TTL):
+            return entry[1]
+        data = get_camera_data(cam)
+        changed = entry is None or entry[1] != data
+        if changed:
+            data_version += 1
+        camera_data_cache[cam] = (datetime.datetime.now().timestamp(), data)
+    persist_camera_data(cam, data, changed)
+    return data
+
+
+def refresh_camera_data(cameras=None):
+    """
+    Rescans the given cameras (all cameras by default) and replaces their cache entries,
+    dropping cameras that disappeared.
+    """
+    global data_version
+    all_cameras = get_camera_list()
+    if cameras is None:
+        cameras = all_cameras
+    cameras = [cam for cam in cameras if cam in all_cameras]
+    scanned = {}
+    if cameras:
+        # Camera directories are independent and scanning is I/O bound, so overlap them
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(SCAN_WORKERS, len(cameras))) as executor:
+            scanned = dict(zip(cameras, executor.map(get_camera_data, cameras)))
+    for cam, data in scanned.items():
+        with camera_data_lock:
+            entry = camera_data_cache.get(cam)
+            # Only invalidate rendered pages when the camera's files actually changed
+            changed = entry is None or entry[1] != data
+            if changed:
+                data_version += 1
+            camera_data_cache[cam] = (datetime.datetime.now().timestamp(), data)
+        persist_camera_data(cam, data, changed)
+    with camera_data_lock:
+        for cam in set(camera_data_cache) - set(all_cameras):
+            del camera_data_cache[cam]
+            data_version += 1
+
+
+def persist_camera_data(cam, data, changed=True):
+    """
+    Stores a camera's data on disk together with the mtime of its directory.
+    For an unchanged rescan with the same mtime only the entry's expiry is renewed,
+    so cameras that stay idle for longer than PERSIST_TTL keep their entry.
+    Persisting is best-effort: failures (e.g. a full disk) are logged and ignored.
+    """
+    if persistent_cache is None:
+        return
+    try:
+        mtime = os.stat(os.path.join(cams_directory, cam)).st_mtime
+        if not changed and persisted_mtimes.get(cam) == mtime and persistent_cache.touch(cam, expire=PERSIST_TTL):
+            return
+        persistent_cache.set(cam, (CAMERA_DATA_FORMAT, mtime, data), expire=PERSIST_TTL)
+        persisted_mtimes[cam] = mtime
+    except Exception as e:
+        print(f"[CACHE] Could not persist data of {cam}: {e}")
+
+
+def load_persisted_camera_data():
+    """
+    Seeds the cache with persisted data of cameras whose directory mtime is unchanged.
+    Files added in nested directories do not change that mtime, so the refresher's
+    initial full scan still revalidates these entries; pages are just served meanwhile.
+    """
+    if persistent_cache is None:
+        return
+    for cam in get_camera_list():
+        persisted = persistent_cache.get(cam)
+        if persisted is None or len(persisted) != 3 or persisted[0] != CAMERA_DATA_FORMAT:
+            continue
+        _, mtime, data = persisted
+        try:
+            if os.stat(os.path.join(cams_directory, cam)).st_mtime != mtime:
+                continue
+        except OSError:
             continue
-        camera_data[cam] = get_camera_data(cam)
-    camera_data_cache = camera_data
-    camera_data_cache_time = now
-    return camera_data
+        with camera_data_lock:
+            camera_data_cache.setdefault(cam, (datetime.datetime.now().timestamp(), data))
+        persisted_mtimes[cam] = mtime
+
+
+def mark_camera_dirty(cam):
+    """Schedules a camera for rescanning by the background refresher."""
+    with camera_dirty_lock:
+        camera_dirty.add(cam)
+    camera_dirty_event.set()
+
+
+class CameraEventHandler(watchdog.events.FileSystemEventHandler):
+    """Marks the camera owning a changed file as dirty."""
+
+    EVENT_TYPES = (
+        watchdog.events.EVENT_TYPE_CREATED,
+        watchdog.events.EVENT_TYPE_MOVED,
+        watchdog.events.EVENT_TYPE_DELETED,
+        watchdog.events.EVENT_TYPE_CLOSED,  # Written file closed: its mtime is final
+    )
+
+    def on_any_event(self, event):
+        global camera_list_cache_time
+        if event.event_type not in self.EVENT_TYPES:
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if not path:
+                continue
+            rel_path = os.path.relpath(os.fsdecode(path), cams_directory)
+            cam, sep, _ = rel_path.partition(os.sep)
+            if not cam.startswith(cams_prefix):
+                continue
+            if not sep:
+                # A camera directory itself was added or removed
+                camera_list_cache_time = 0
+            mark_camera_dirty(cam)
+
+
+def start_file_watcher():
+    """
+    Starts watching cams_directory so cameras are only rescanned after they change.
+    If the watcher cannot start (e.g. the inotify watch limit is reached), watching stays
+    False and the refresher falls back to periodic rescans.
+    """
+    global watching
+    observer = watchdog.observers.Observer()
+    observer.daemon = True
+    try:
+        observer.schedule(CameraEventHandler(), cams_directory, recursive=True)
+        observer.start()
+    except OSError as e:
+        print(f"[CACHE] Not watching {cams_directory}, falling back to periodic rescans: {e}")
+        return
+    watching = True
+
+
+def start_cache_refresher():
+    """Starts a daemon thread that keeps the camera cache warm."""
+    def run():
+        cameras = None  # Start with a full scan
+        last_full_scan = 0
+        while True:
+            if cameras is None:
+                last_full_scan = time.monotonic()
+            try:
+                refresh_camera_data(cameras)
+            except Exception as e:
+                # Keep the thread alive; the next rescan may well succeed
+                print(f"[CACHE] Refresh failed: {e}")
+            if watching:
+                # Rescan everything now and then, in case events were lost
+                full_scan_in = last_full_scan + WATCH_FULL_RESCAN_INTERVAL - time.monotonic()
+                if full_scan_in <= 0 or not camera_dirty_event.wait(full_scan_in):
+                    cameras = None
+                    continue
+                time.sleep(WATCH_DEBOUNCE)
+                with camera_dirty_lock:
+                    camera_dirty_event.clear()
+                    cameras = sorted(camera_dirty)
+                    camera_dirty.clear()
+            else:
+                time.sleep(CACHE_REFRESH_INTERVAL)
+    threading.Thread(target=run, name="camera-cache-refresher", daemon=True).start()
+
+
+def make_page_cache_key(*args, **kwargs):
+    """Cache key for rendered pages: the request path plus the current data version."""
+    return f"page:{flask.request.path}:v{data_version}"
 
 
 # Home page: lists all available cameras
 @app.route('/')
+@cache.cached(make_cache_key=make_page_cache_key)
 def index():
-    cameras = sorted([cam for cam in get_all_camera_data().keys()])
-    camera_list_html = "<ul>" + "".join(f'<li><a href="/camera/{cam}">{cam}</a></li>' for cam in cameras) + "</ul>"
+    get_camera_list()  # Refreshes camera_list_html when the cameras changed
     return f"""
 <!DOCTYPE html>
 <html lang='en'>
@@ -127,19 +462,18 @@ def index():
 </html>"""
 
 # Camera details page: shows stats and available dates
-@app.route('/camera/<cam_name>')
+@app.route('/camera/<cam:cam_name>')
 def camera_detail(cam_name):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    all_data = get_all_camera_data()
-    if cam_name not in all_data:
+    if cam_name not in get_camera_list():
         return "Camera not found", 404
-    data = all_data[cam_name]
+    return get_cached_camera_data(cam_name)['html']['detail']
+
+
+def render_camera_detail(cam_name, data):
     # Count files per date (photos + videos)
-    date_counts = {}
-    for ts in list(data['videos'].keys()) + list(data['photos'].keys()):
-        date = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
-        date_counts[date] = date_counts.get(date, 0) + 1
+    date_counts = {date: len(files) for date, files in data['videos_by_date'].items()}
+    for date, files in data['photos_by_date'].items():
+        date_counts[date] = date_counts.get(date, 0) + len(files)
     dates = sorted(date_counts.keys())
     dates_html = "<ul>" + "".join(f"<li>{date} ({date_counts[date]})</li>" for date in dates) + "</ul>"
     num_videos = len(data['videos'])
@@ -177,17 +511,17 @@ def camera_detail(cam_name):
 </html>"""
 
 # Video date list: shows all dates with videos for a camera
-@app.route('/camera/<cam_name>/videos')
+@app.route('/camera/<cam:cam_name>/videos')
 def camera_videos_dates(cam_name):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    return get_cached_camera_data(cam_name)['html']['video_dates']
+
+
+def render_camera_videos_dates(cam_name, data):
     # Count videos per date
-    date_counts = {}
-    for ts in data['videos']:
-        date = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
-        date_counts[date] = date_counts.get(date, 0) + 1
-    video_dates = sorted(date_counts.keys())
+    date_counts = {date: len(files) for date, files in data['videos_by_date'].items()}
+    video_dates = data['video_dates']
     dates_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/videos/{date}'>{date}</a> ({date_counts[date]})</li>" for date in video_dates) + "</ul>"
     return f"""
 <!DOCTYPE html>
@@ -217,13 +551,17 @@ def camera_videos_dates(cam_name):
 </html>"""
 
 # Video file list for a specific date
-@app.route('/camera/<cam_name>/videos/<date>')
+@app.route('/camera/<cam:cam_name>/videos/<date>')
 def camera_videos_files(cam_name, date):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
-    files = sorted([(ts, data['videos'][ts]) for ts in data['videos'] if datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d') == date])
-    files_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/videos/{date}/{idx}'>{datetime.datetime.fromtimestamp(ts).strftime('%H:%M:%S')}</a></li>" for idx, (ts, file) in enumerate(files)) + "</ul>"
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    html = get_cached_camera_data(cam_name)['html']['videos_by_date'].get(date)
+    # Dates without videos are not pre-rendered; show them as an empty list
+    return html if html is not None else render_camera_videos_files(cam_name, date, [])
+
+
+def render_camera_videos_files(cam_name, date, files):
+    files_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/videos/{date}/{idx}'>{_fmt_time(ts)}</a></li>" for idx, (ts, file) in enumerate(files)) + "</ul>"
     return f"""
 <!DOCTYPE html>
 <html lang='en'>
@@ -253,17 +591,17 @@ def camera_videos_files(cam_name, date):
 </html>"""
 
 # Photo date list: shows all dates with photos for a camera
-@app.route('/camera/<cam_name>/photos')
+@app.route('/camera/<cam:cam_name>/photos')
 def camera_photos_dates(cam_name):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    return get_cached_camera_data(cam_name)['html']['photo_dates']
+
+
+def render_camera_photos_dates(cam_name, data):
     # Count photos per date
-    date_counts = {}
-    for ts in data['photos']:
-        date = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
-        date_counts[date] = date_counts.get(date, 0) + 1
-    photo_dates = sorted(date_counts.keys())
+    date_counts = {date: len(files) for date, files in data['photos_by_date'].items()}
+    photo_dates = data['photo_dates']
     dates_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/photos/{date}'>{date}</a> ({date_counts[date]})</li>" for date in photo_dates) + "</ul>"
     return f"""
 <!DOCTYPE html>
@@ -293,13 +631,17 @@ def camera_photos_dates(cam_name):
 </html>"""
 
 # Photo file list for a specific date
-@app.route('/camera/<cam_name>/photos/<date>')
+@app.route('/camera/<cam:cam_name>/photos/<date>')
 def camera_photos_files(cam_name, date):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
-    files = sorted([(ts, data['photos'][ts]) for ts in data['photos'] if datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d') == date])
-    files_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/photos/{date}/{idx}'>{datetime.datetime.fromtimestamp(ts).strftime('%H:%M:%S')}</a></li>" for idx, (ts, file) in enumerate(files)) + "</ul>"
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    html = get_cached_camera_data(cam_name)['html']['photos_by_date'].get(date)
+    # Dates without photos are not pre-rendered; show them as an empty list
+    return html if html is not None else render_camera_photos_files(cam_name, date, [])
+
+
+def render_camera_photos_files(cam_name, date, files):
+    files_html = "<ul>" + "".join(f"<li><a href='/camera/{cam_name}/photos/{date}/{idx}'>{_fmt_time(ts)}</a></li>" for idx, (ts, file) in enumerate(files)) + "</ul>"
     return f"""
 <!DOCTYPE html>
 <html lang='en'>
@@ -329,11 +671,26 @@ def camera_photos_files(cam_name, date):
 </html>"""
 
 
-@app.route('/camera/<cam_name>/videos/<date>/<int:file_idx>')
+def render_camera_pages(cam_name, data):
+    """
+    Renders the camera's detail, date list and per-date file list pages.
+    Done once per scan, so those views only look up the finished HTML.
+    """
+    return {
+        'detail': render_camera_detail(cam_name, data),
+        'video_dates': render_camera_videos_dates(cam_name, data),
+        'photo_dates': render_camera_photos_dates(cam_name, data),
+        'videos_by_date': {date: render_camera_videos_files(cam_name, date, files) for date, files in data['videos_by_date'].items()},
+        'photos_by_date': {date: render_camera_photos_files(cam_name, date, files) for date, files in data['photos_by_date'].items()},
+    }
+
+
+@app.route('/camera/<cam:cam_name>/videos/<date>/<int:file_idx>')
+@cache.cached(make_cache_key=make_page_cache_key)
 def camera_video_viewer(cam_name, date, file_idx):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    data = get_cached_camera_data(cam_name)
     files = data['videos_by_date'].get(date, [])
     if file_idx < 0 or file_idx >= len(files):
         return "File not found", 404
@@ -357,12 +714,9 @@ def camera_video_viewer(cam_name, date, file_idx):
     else:
         next_link = ""
     video_url = f"/media/{cam_name}/{file}"
-    photo_candidates = list(data['photos'].items())
-    if photo_candidates:
-        nearest_photo_ts, nearest_photo_file = min(photo_candidates, key=lambda x: abs(x[0] - ts))
-        nearest_photo_date, _ = format_cet(nearest_photo_ts)
-        photo_files = data['photos_by_date'][nearest_photo_date]
-        photo_idx = [i for i, (t, f) in enumerate(photo_files) if t == nearest_photo_ts][0]
+    if data['photo_ts_sorted']:
+        nearest_photo_ts = nearest_timestamp(data['photo_ts_sorted'], ts)
+        nearest_photo_date, photo_idx = data['photo_ts_to_date_idx'][nearest_photo_ts]
         photo_link = f"<div style='margin-top:1em;'><a href='/camera/{cam_name}/photos/{nearest_photo_date}/{photo_idx}'>Go to nearest photo</a></div>"
     else:
         photo_link = ""
@@ -397,11 +751,12 @@ def camera_video_viewer(cam_name, date, file_idx):
 </html>"""
 
 
-@app.route('/camera/<cam_name>/photos/<date>/<int:file_idx>')
+@app.route('/camera/<cam:cam_name>/photos/<date>/<int:file_idx>')
+@cache.cached(make_cache_key=make_page_cache_key)
 def camera_photo_viewer(cam_name, date, file_idx):
-    if not cam_name.startswith("cam"):
-        return "Invalid camera name", 404
-    data = get_all_camera_data()[cam_name]
+    if cam_name not in get_camera_list():
+        return "Camera not found", 404
+    data = get_cached_camera_data(cam_name)
     files = data['photos_by_date'].get(date, [])
     if file_idx < 0 or file_idx >= len(files):
         return "File not found", 404
@@ -425,12 +780,9 @@ def camera_photo_viewer(cam_name, date, file_idx):
     else:
         next_link = ""
     photo_url = f"/media/{cam_name}/{file}"
-    video_candidates = list(data['videos'].items())
-    if video_candidates:
-        nearest_video_ts, nearest_video_file = min(video_candidates, key=lambda x: abs(x[0] - ts))
-        nearest_video_date, _ = format_cet(nearest_video_ts)
-        video_files = data['videos_by_date'][nearest_video_date]
-        video_idx = [i for i, (t, f) in enumerate(video_files) if t == nearest_video_ts][0]
+    if data['video_ts_sorted']:
+        nearest_video_ts = nearest_timestamp(data['video_ts_sorted'], ts)
+        nearest_video_date, video_idx = data['video_ts_to_date_idx'][nearest_video_ts]
         video_link = f"<div style='margin-top:1em;'><a href='/camera/{cam_name}/videos/{nearest_video_date}/{video_idx}'>Go to nearest video</a></div>"
     else:
         video_link = ""
@@ -465,22 +817,27 @@ def camera_photo_viewer(cam_name, date, file_idx):
 </html>"""
 
 
-@app.route('/media/<cam_name>/<path:filename>')
+@app.route('/media/<cam:cam_name>/<path:filename>')
 def serve_media(cam_name, filename):
-    if not cam_name.startswith("cam"):
+    try:
+        abs_cam_dir = get_cached_camera_data(cam_name)['abs_root']
+    except KeyError:
+        if debug:
+            print(f"[MEDIA] Camera not found: {cam_name}")
+        return "Camera not found", 404
+    try:
+        abs_media_path = os.path.realpath(os.path.join(abs_cam_dir, filename))
+        in_cam_dir = os.path.commonpath([abs_media_path, abs_cam_dir]) == abs_cam_dir
+    except ValueError:
+        # e.g. an embedded null byte in the file name
         if debug:
-            print(f"[MEDIA] Invalid camera name: {cam_name}")
-        return "Invalid camera name", 404
-    safe_filename = os.path.normpath(filename).replace('..', '')
-    media_path = os.path.join(cams_directory, cam_name, safe_filename)
-    abs_media_path = os.path.abspath(media_path)
-    abs_cam_dir = os.path.abspath(os.path.join(cams_directory, cam_name))
+            print(f"[MEDIA] Invalid file path: {filename!r}")
+        return "Invalid file path", 404
     if debug:
-        print(f"[MEDIA] cam_name={cam_name} safe_filename={safe_filename}")
-        print(f"[MEDIA] media_path={media_path}")
+        print(f"[MEDIA] cam_name={cam_name} filename={filename}")
         print(f"[MEDIA] abs_media_path={abs_media_path}")
         print(f"[MEDIA] abs_cam_dir={abs_cam_dir}")
-    if not abs_media_path.startswith(abs_cam_dir):
+    if not in_cam_dir:
         if debug:
             print(f"[MEDIA] Invalid file path: {abs_media_path} not in {abs_cam_dir}")
         return "Invalid file path", 404
@@ -489,8 +846,16 @@ def serve_media(cam_name, filename):
             print(f"[MEDIA] File not found: {abs_media_path}")
         return "File not found", 404
 
-    # Serve .jpg and .mp4 directly
+    # Serve .jpg and .mp4 directly, or let nginx send them when it is in front
     if abs_media_path.endswith('.jpg') or abs_media_path.endswith('.mp4'):
+        if accel_redirect:
+            rel_path = os.path.relpath(abs_media_path, abs_cam_dir).replace(os.sep, '/')
+            internal_uri = urllib.parse.quote(f"{accel_redirect.rstrip('/')}/{cam_name}/{rel_path}")
+            if debug:
+                print(f"[MEDIA] X-Accel-Redirect: {internal_uri}")
+            response = flask.Response(mimetype=mimetypes.guess_type(abs_media_path)[0])
+            response.headers['X-Accel-Redirect'] = internal_uri
+            return response
         return flask.send_file(abs_media_path)
     # Transcode .mkv to .mp4 on the fly
     elif abs_media_path.endswith('.mkv'):
@@ -508,17 +873,20 @@ def serve_media(cam_name, filename):
                 '-analyzeduration', '0', '-probesize', '32',
                 '-y', '-loglevel', 'error', '-'
             ]
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=4096)
+            # stderr goes to the container log instead of a pipe nobody reads, which could fill up and stall ffmpeg
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=None, bufsize=MKV_STREAM_CHUNK_SIZE)
             try:
                 while True:
-                    chunk = p.stdout.read(4096)
+                    # read1 returns whatever the pipe holds (one read syscall) instead of
+                    # blocking until a full chunk has been transcoded
+                    chunk = p.stdout.read1(MKV_STREAM_CHUNK_SIZE)
                     if not chunk:
                         break
                     yield chunk
             finally:
                 p.stdout.close()
-                p.stderr.close()
                 p.terminate()
+                p.wait()
         return Response(generate(), mimetype='video/mp4')
     else:
         return "Unsupported file type", 415
@@ -533,64 +901,142 @@ def get_camera_data(cam):
     cam_path = os.path.join(cams_directory, cam)
     video_files = {}
     photo_files = {}
-    # Walk the camera directory tree
-    for root, dirs, files in os.walk(cam_path):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, os.path.join(cams_directory, cam)).replace(os.sep, '/')
-            # Get mtime as UTC, then convert to CET
-            mtime_utc = datetime.datetime.fromtimestamp(os.path.getmtime(full_path), datetime.timezone.utc)
-            mtime_cet = mtime_utc.astimezone(CET)
-            timestamp = int(mtime_cet.timestamp())
-            if is_extension_in_list(file, cams_images_extentions):
-                photo_files[timestamp] = rel_path
-                continue
-            elif is_extension_in_list(file, cams_videos_extentions):
-                video_files[timestamp] = rel_path
-                continue
-    # Precompute date groupings and sorted lists
-    def group_by_date(files_dict):
-        by_date = {}
-        for ts, rel_path in files_dict.items():
-            # Use CET date directly from mtime_cet
-            dt_cet = datetime.datetime.fromtimestamp(ts, CET)
-            date = dt_cet.strftime('%Y-%m-%d')
-            by_date.setdefault(date, []).append((ts, rel_path))
-        # Sort each date's list by timestamp
-        for date in by_date:
-            by_date[date].sort()
-        return by_date
-    videos_by_date = group_by_date(video_files)
-    photos_by_date = group_by_date(photo_files)
-    video_dates = sorted(videos_by_date.keys())
-    photo_dates = sorted(photos_by_date.keys())
-    return {
+    # Walk the camera directory tree, tracking the relative path during descent
+    def scan(dir_path, rel_prefix):
+        try:
+            entries = os.scandir(dir_path)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    # Hidden directories (.Trash, .snapshot, ...) never hold camera files
+                    if not entry.name.startswith('.'):
+                        scan(entry.path, rel_prefix + entry.name + '/')
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext in _IMG_EXTS:
+                    target = photo_files
+                elif ext in _VID_EXTS:
+                    target = video_files
+                else:
+                    continue
+                # Only files with a media extension get here, so nothing else is stat'ed.
+                # mtime is seconds since epoch; CET conversion happens when formatting
+                try:
+                    timestamp = int(entry.stat().st_mtime)
+                except OSError:
+                    continue
+                target[timestamp] = rel_prefix + entry.name
+    scan(cam_path, '')
+    # Precompute date groupings and sorted lists in one pass over all files in time order,
+    # so every date's file list and the lists of dates come out already sorted
+    timestamps = list(video_files) + list(photo_files)
+    rel_paths = list(video_files.values()) + list(photo_files.values())
+    num_videos = len(video_files)
+    ts_arr = np.array(timestamps, dtype='int64')
+    order = np.argsort(ts_arr, kind='stable')
+    day_numbers = cet_day_numbers(ts_arr[order])
+    videos_by_date, photos_by_date = {}, {}
+    video_dates, photo_dates = [], []
+    video_ts_sorted, photo_ts_sorted = [], []
+    # Position of each timestamp in the date lists, for nearest-file lookups
+    video_ts_to_date_idx, photo_ts_to_date_idx = {}, {}
+    # Files of one day are adjacent in time order, so each date string is formatted once
+    for day, group in itertools.groupby(zip(day_numbers.tolist(), order.tolist()), key=lambda x: x[0]):
+        date = (EPOCH_DATE + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+        for _, i in group:
+            if i < num_videos:
+                by_date, kind_dates, ts_sorted, ts_to_date_idx = videos_by_date, video_dates, video_ts_sorted, video_ts_to_date_idx
+            else:
+                by_date, kind_dates, ts_sorted, ts_to_date_idx = photos_by_date, photo_dates, photo_ts_sorted, photo_ts_to_date_idx
+            ts = timestamps[i]
+            files = by_date.get(date)
+            if files is None:
+                files = by_date[date] = []
+                kind_dates.append(date)
+            ts_to_date_idx[ts] = (date, len(files))
+            files.append((ts, rel_paths[i]))
+            ts_sorted.append(ts)
+    data = {
+        "abs_root": os.path.realpath(cam_path),
         "videos": video_files,
         "photos": photo_files,
         "videos_by_date": videos_by_date,
         "photos_by_date": photos_by_date,
         "video_dates": video_dates,
         "photo_dates": photo_dates,
+        "video_ts_sorted": video_ts_sorted,
+        "photo_ts_sorted": photo_ts_sorted,
+        "video_ts_to_date_idx": video_ts_to_date_idx,
+        "photo_ts_to_date_idx": photo_ts_to_date_idx,
     }
+    data["html"] = render_camera_pages(cam, data)
+    return data
+
 
+def normalize_extensions(extensions):
+    """Return a frozenset of lowercase extensions, each with a leading dot."""
+    return frozenset(ext.lower() if ext.startswith('.') else '.' + ext.lower() for ext in extensions)
 
-def is_extension_in_list(filename, extensions):
-    """Check if the file has one of the specified extensions."""
-    return any(filename.lower().endswith(ext.lower()) for ext in extensions)
+
+def nearest_timestamp(sorted_ts, ts):
+    """Return the value in the non-empty sorted list closest to ts (the earlier one on ties)."""
+    i = bisect.bisect_left(sorted_ts, ts)
+    if i == 0:
+        return sorted_ts[0]
+    if i == len(sorted_ts):
+        return sorted_ts[-1]
+    before, after = sorted_ts[i - 1], sorted_ts[i]
+    return before if ts - before <= after - ts else after
 
 
 def get_sorted_files_by_date(data, key):
-    files = [(datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d'), ts, data[key][ts]) for ts in data[key]]
+    files = [(_fmt_date(ts), ts, data[key][ts]) for ts in data[key]]
     return sorted(files)
 
+def cet_day_numbers(sorted_ts):
+    """Return the CET/CEST local day (days since 1970-01-01) of each timestamp in a sorted int64 array."""
+    if not sorted_ts.size:
+        return sorted_ts
+    # UTC offsets only change on whole hours, so look them up once per distinct hour;
+    # the input is sorted, so equal hours are adjacent
+    hours = sorted_ts // 3600
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(hours)) + 1))
+    offsets = np.array([
+        datetime.datetime.fromtimestamp(int(hour) * 3600, CET).utcoffset().total_seconds()
+        for hour in hours[starts]
+    ], dtype='int64')
+    counts = np.diff(np.concatenate((starts, [sorted_ts.size])))
+    return (sorted_ts + np.repeat(offsets, counts)) // 86400
+
 # Helper function to format timestamps in CET/CEST
 
+@functools.lru_cache(maxsize=200_000)
+def _fmt_date(ts):
+    """Format a timestamp (seconds since epoch) as CET/CEST 'YYYY-MM-DD'."""
+    return datetime.datetime.fromtimestamp(ts, CET).strftime('%Y-%m-%d')
+
+
+@functools.lru_cache(maxsize=200_000)
+def _fmt_time(ts):
+    """Format a timestamp (seconds since epoch) as CET/CEST 'HH:MM:SS'."""
+    return datetime.datetime.fromtimestamp(ts, CET).strftime('%H:%M:%S')
+
+
 def format_cet(ts):
     """Format a timestamp (seconds since epoch) as CET/CEST local time string."""
-    dt_cet = datetime.datetime.fromtimestamp(ts, CET)
-    return dt_cet.strftime('%Y-%m-%d'), dt_cet.strftime('%H:%M:%S')
+    return _fmt_date(ts), _fmt_time(ts)
 
 
+# Environment configuration for WSGI servers importing the app; __main__ re-reads argv
+_configure_from_env()
+
 if __name__ == "__main__":
-    init()
-    app.run(host='0.0.0.0', port=port, debug=debug)
+    _configure_from_argv()
+    start_background_workers()
+    if debug:
+        app.run(host='0.0.0.0', port=port, debug=debug)
+    else:
+        # Each request gets its own thread, so a long mkv transcode does not block other requests
+        waitress.serve(app, host='0.0.0.0', port=port, threads=threads)